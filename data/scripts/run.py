@@ -25,7 +25,8 @@ def main():
     
     try:
         # Process all conversations and store only requirements
-        agent.process_all_requirements(email_file)
+        # (pass --batch-api to submit the AI requests through the OpenAI Batch API)
+        agent.process_all_requirements(email_file, use_batch_api='--batch-api' in sys.argv)
         
         # Display summary
         agent.get_requirements_summary()
@@ -1,114 +1,497 @@
-from openai import AzureOpenAI, OpenAI
-from typing import Dict, List
+import asyncio
+import hashlib
+import httpx
+import json
+import tiktoken
+from collections import OrderedDict
+from datetime import datetime
+from openai import AsyncAzureOpenAI, AsyncOpenAI
+from pymongo import UpdateOne
+from typing import Dict, List, Optional
 from src.config import Config
+from src.rate_limiter import RateLimiter
+
+# Number of classifications kept in the in-process (L1) cache
+CLASSIFICATION_CACHE_SIZE = 4096
+
+# Prompt templates: static text around the email thread, built once at import
+_CLASSIFICATION_CRITERIA = """A 'requirement' thread contains:
+- Technical requirements
+- Feature requests
+- System specifications
+- Project scope discussions
+- Business needs
+
+A 'general' thread contains:
+- Casual conversations
+- Meeting follow-ups without requirements
+- Administrative messages
+- Holiday schedules
+- Thank you notes"""
+
+_EXTRACTION_FIELDS = """For each requirement, provide:
+1. Requirement text (clear and concise)
+2. Category (e.g., functionality, performance, integration, security, deployment)
+3. Priority (high, medium, low)"""
+
+_CLASSIFY_PREFIX = (
+    "Analyze the following email thread and classify it as either 'requirement' or 'general'.\n\n"
+    + _CLASSIFICATION_CRITERIA
+    + "\n\nEmail Thread:\n"
+)
+_CLASSIFY_SUFFIX = "\n\nResponse format: Respond with the single letter 'R' for requirement or 'G' for general."
+
+_CLASSIFY_BATCH_PREFIX = (
+    "Classify each of the following email threads independently as either 'requirement' or 'general'.\n\n"
+    + _CLASSIFICATION_CRITERIA
+    + "\n\nEmail Threads:\n"
+)
+_CLASSIFY_BATCH_SUFFIX = "\n\nResponse format: One letter per THREAD marker above, in order and with nothing between them: 'R' for requirement or 'G' for general."
+
+_EXTRACT_PREFIX = (
+    "Extract all technical requirements from this email thread.\n\n"
+    + _EXTRACTION_FIELDS
+    + "\n\nEmail Thread:\n"
+)
+_EXTRACT_SUFFIX = """
+
+Response format: A JSON object of the form
+{"requirements": [{"text": "...", "category": "...", "priority": "..."}]}"""
+
+_EXTRACT_BATCH_PREFIX = (
+    "Extract the technical requirements from each of the following email threads independently.\n\n"
+    + _EXTRACTION_FIELDS
+    + "\n\nEmail Threads:\n"
+)
+_EXTRACT_BATCH_SUFFIX = """
+
+Response format: A JSON object with exactly one result for every THREAD marker above, of the form
+{"results": [{"index": <thread number>, "requirements": [{"text": "...", "category": "...", "priority": "..."}]}]}"""
+
+_CLASSIFY_AND_EXTRACT_PREFIX = (
+    "Analyze the following email thread, classify it as either 'requirement' or 'general', and extract its technical requirements.\n\n"
+    + _CLASSIFICATION_CRITERIA
+    + "\n\n"
+    + _EXTRACTION_FIELDS
+    + "\n\nEmail Thread:\n"
+)
+_CLASSIFY_AND_EXTRACT_SUFFIX = """
+
+Response format: A JSON object of the form
+{"category": "requirement" or "general", "requirements": [{"text": "...", "category": "...", "priority": "..."}]}
+Use an empty "requirements" list for 'general' threads."""
+
+_CLASSIFY_SYSTEM_MSG = {"role": "system", "content": "You are an email classification expert."}
+_EXTRACT_SYSTEM_MSG = {"role": "system", "content": "You are a requirements extraction expert."}
+_CLASSIFY_AND_EXTRACT_SYSTEM_MSG = {"role": "system", "content": "You are an email classification and requirements extraction expert."}
+
+def format_thread(thread: Dict) -> str:
+    """Render a thread's emails as the prompt text shared by every AI call"""
+    return "\n\n".join([
+        f"From: {email.get('from')}\nTo: {email.get('to')}\nDate: {email.get('date')}\nSubject: {email.get('subject')}\nBody: {email.get('body')}"
+        for email in thread['emails']
+    ])
 
 class AIEmailProcessor:
     """AI-powered email processor using OpenAI/Azure OpenAI"""
     
-    def __init__(self):
-        """Initialize AI client"""
+    def __init__(self, db=None):
+        """Initialize AI client
+        
+        When a MongoDB database is given, classifications are persisted in its
+        'classification_cache' collection so re-runs skip threads already seen.
+        """
+        self._l1 = OrderedDict()
+        self.cache_collection = db['classification_cache'] if db is not None else None
+        self.rl = RateLimiter(Config.OPENAI_RPM, Config.OPENAI_TPM)
+        
+        # Keep-alive HTTP/2 transport: concurrent requests share one TLS connection.
+        # The SDK's 600s read timeout is kept, since batched extractions can generate for minutes
+        self._http = httpx.AsyncClient(
+            http2=True,
+            timeout=httpx.Timeout(600.0, connect=10.0),
+            limits=httpx.Limits(max_keepalive_connections=100, max_connections=100)
+        )
+        
         if Config.AZURE_OPENAI_API_KEY:
             # Use Azure OpenAI
-            self.client = AzureOpenAI(
+            self.client = AsyncAzureOpenAI(
                 api_key=Config.AZURE_OPENAI_API_KEY,
                 api_version=Config.AZURE_OPENAI_API_VERSION,
-                azure_endpoint=Config.AZURE_OPENAI_ENDPOINT
+                azure_endpoint=Config.AZURE_OPENAI_ENDPOINT,
+                http_client=self._http
             )
             self.model = Config.AZURE_OPENAI_DEPLOYMENT
+            self.classify_model = Config.AZURE_OPENAI_CLASSIFY_DEPLOYMENT
             self.use_azure = True
         else:
             # Use OpenAI
-            self.client = OpenAI(api_key=Config.OPENAI_API_KEY)
+            self.client = AsyncOpenAI(api_key=Config.OPENAI_API_KEY, http_client=self._http)
             self.model = Config.OPENAI_MODEL
+            self.classify_model = Config.CLASSIFY_MODEL
             self.use_azure = False
+        
+        # Restrict the classifier's output to a single 'R' or 'G' token
+        try:
+            encoding = self._encoding_for(self.classify_model)
+            self._label_bias = {str(encoding.encode(label)[0]): 100 for label in ['R', 'G']}
+        except Exception as e:
+            # tiktoken downloads its encodings on first use; classification still works without the bias
+            print(f"⚠️  Tokenizer unavailable, classifying without logit bias: {e}")
+            self._label_bias = None
+        
+        try:
+            self._truncation_encoding = tiktoken.get_encoding('cl100k_base')
+        except Exception as e:
+            print(f"⚠️  Tokenizer unavailable, sending email threads untruncated: {e}")
+            self._truncation_encoding = None
     
-    def classify_email_thread(self, thread: Dict) -> str:
-        """Classify if thread is requirement or general using AI"""
+    def _encoding_for(self, model: str):
+        """Tokenizer for a model; Azure deployment names fall back to the gpt-4o family encoding"""
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding('o200k_base')
+    
+    async def aclose(self):
+        """Close the HTTP connection pool"""
+        await self._http.aclose()
+    
+    async def classify_email_threads(self, emails_texts: List[str]) -> List[str]:
+        """Classify several threads with one classify-model request, caching the labels with one write"""
+        cache_keys = [self._cache_key(emails_text) for emails_text in emails_texts]
+        cached = await self._get_cached_categories(cache_keys)
         
-        # Prepare email content
-        emails_text = "\n\n".join([
-            f"From: {email.get('from')}\nTo: {email.get('to')}\nSubject: {email.get('subject')}\nBody: {email.get('body')}"
-            for email in thread['emails']
-        ])
+        pending = [i for i, key in enumerate(cache_keys) if key not in cached]
+        pending_texts = [emails_texts[i] for i in pending]
+        
+        if len(pending_texts) > 1:
+            labels = await self._classify_many(pending_texts)
+        else:
+            labels = [await self._classify_one(emails_text) for emails_text in pending_texts]
+        
+        categories = {cache_keys[i]: label for i, label in zip(pending, labels)}
+        await self._cache_categories(categories)
+        
+        return [cached.get(key) or categories[key] for key in cache_keys]
+    
+    async def _classify_one(self, emails_text: str) -> str:
+        """Label one thread with the classify model (API errors propagate)"""
+        prompt = _CLASSIFY_PREFIX + self._truncate(emails_text, Config.MAX_INPUT_TOKENS) + _CLASSIFY_SUFFIX
+        
+        response = await self._create_completion(**self._classify_request(prompt, 1))
+        
+        content = response.choices[0].message.content or ''
+        return 'requirement' if content.strip().upper().startswith('R') else 'general'
+    
+    async def _classify_many(self, emails_texts: List[str]) -> List[str]:
+        """Label several threads in one request, one 'R'/'G' token each, falling back to one request per thread"""
+        threads_text = self._pack_threads(
+            emails_texts,
+            len(emails_texts),
+            _CLASSIFY_SYSTEM_MSG['content'] + _CLASSIFY_BATCH_PREFIX + _CLASSIFY_BATCH_SUFFIX
+        )
+        prompt = _CLASSIFY_BATCH_PREFIX + threads_text + _CLASSIFY_BATCH_SUFFIX
+        
+        response = await self._create_completion(**self._classify_request(prompt, len(emails_texts)))
+        
+        labels = ''.join((response.choices[0].message.content or '').split()).upper()
+        if len(labels) == len(emails_texts) and set(labels) <= {'R', 'G'}:
+            return ['requirement' if label == 'R' else 'general' for label in labels]
+        
+        # Only a malformed response is retried per thread; API errors (429, 5xx) propagate
+        print(f"⚠️  AI classification response unusable ({labels[:20]!r}), retrying threads individually")
+        return list(await asyncio.gather(*[self._classify_one(emails_text) for emails_text in emails_texts]))
+    
+    def _classify_request(self, prompt: str, labels: int) -> Dict:
+        """Build a classify-model request answered with one biased 'R'/'G' token per thread"""
+        # A binary label needs neither the primary model nor sampling
+        request = {
+            'model': self.classify_model,
+            'messages': [
+                _CLASSIFY_SYSTEM_MSG,
+                {"role": "user", "content": prompt}
+            ],
+            'temperature': 0,
+            'max_tokens': labels
+        }
+        if self._label_bias:
+            request['logit_bias'] = self._label_bias
+        
+        return request
+    
+    async def extract_requirements_batch(self, emails_texts: List[str]) -> List[Optional[List[Dict]]]:
+        """Extract requirements from threads already classified as requirements, in one AI call
+        
+        A thread whose AI response is unusable gets None, leaving the caller to decide.
+        """
+        if len(emails_texts) > 1:
+            return await self._extract_many(emails_texts)
+        
+        return [await self._extract_one(emails_text) for emails_text in emails_texts]
+    
+    async def _extract_one(self, emails_text: str) -> Optional[List[Dict]]:
+        """Extract one thread's requirements, returning None if the AI response is unusable"""
+        prompt = _EXTRACT_PREFIX + self._truncate(emails_text, Config.MAX_INPUT_TOKENS) + _EXTRACT_SUFFIX
+        
+        response = await self._create_completion(
+            model=self.model,
+            messages=[
+                _EXTRACT_SYSTEM_MSG,
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0.3,
+            max_tokens=1000,
+            response_format={"type": "json_object"}
+        )
         
-        prompt = f"""Analyze the following email thread and classify it as either 'requirement' or 'general'.
-
-A 'requirement' thread contains:
-- Technical requirements
-- Feature requests
-- System specifications
-- Project scope discussions
-- Business needs
-
-A 'general' thread contains:
-- Casual conversations
-- Meeting follow-ups without requirements
-- Administrative messages
-- Holiday schedules
-- Thank you notes
-
-Email Thread:
-{emails_text}
-
-Response format: Just respond with either 'requirement' or 'general'."""
-
         try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": "You are an email classification expert."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.3,
-                max_tokens=10
-            )
+            return self._normalize_requirements(json.loads(response.choices[0].message.content)['requirements'])
+        except (json.JSONDecodeError, KeyError, TypeError, ValueError) as e:
+            # API errors propagate so callers can fall back to keyword classification
+            print(f"❌ AI response unusable: {e}")
+            return None
+    
+    async def _extract_many(self, emails_texts: List[str]) -> List[Optional[List[Dict]]]:
+        """Send several threads to the AI in one request, falling back to one request per thread"""
+        max_tokens = min(1000 * len(emails_texts), Config.MODEL_CONTEXT_TOKENS // 4)
+        threads_text = self._pack_threads(
+            emails_texts,
+            max_tokens,
+            _EXTRACT_SYSTEM_MSG['content'] + _EXTRACT_BATCH_PREFIX + _EXTRACT_BATCH_SUFFIX
+        )
+        prompt = _EXTRACT_BATCH_PREFIX + threads_text + _EXTRACT_BATCH_SUFFIX
+        
+        response = await self._create_completion(
+            model=self.model,
+            messages=[
+                _EXTRACT_SYSTEM_MSG,
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0.3,
+            max_tokens=max_tokens,
+            response_format={"type": "json_object"}
+        )
+        
+        try:
+            by_index = {
+                int(result['index']): self._normalize_requirements(result.get('requirements'))
+                for result in json.loads(response.choices[0].message.content)['results']
+            }
+            if set(by_index) != set(range(len(emails_texts))):
+                raise ValueError(f"expected {len(emails_texts)} results, got indexes {sorted(by_index)}")
             
-            classification = response.choices[0].message.content.strip().lower()
-            return classification if classification in ['requirement', 'general'] else 'general'
+            return [by_index[i] for i in range(len(emails_texts))]
         
-        except Exception as e:
-            print(f"❌ AI classification failed: {e}")
-            return 'general'
+        except (json.JSONDecodeError, KeyError, TypeError, ValueError) as e:
+            # Only a malformed response is retried per thread; API errors (429, 5xx) propagate
+            print(f"⚠️  AI batch response unusable ({e}), retrying threads individually")
+            return list(await asyncio.gather(*[self._extract_one(emails_text) for emails_text in emails_texts]))
     
-    def extract_requirements(self, thread: Dict) -> List[Dict]:
-        """Extract structured requirements using AI"""
+    def _classify_and_extract_request(self, emails_text: str) -> Dict:
+        """Build the Batch API request body that classifies a thread and extracts its requirements"""
+        prompt = (
+            _CLASSIFY_AND_EXTRACT_PREFIX
+            + self._truncate(emails_text, Config.MAX_INPUT_TOKENS)
+            + _CLASSIFY_AND_EXTRACT_SUFFIX
+        )
         
-        emails_text = "\n\n".join([
-            f"From: {email.get('from')}\nDate: {email.get('date')}\nBody: {email.get('body')}"
-            for email in thread['emails']
+        return {
+            'model': self.model,
+            'messages': [
+                _CLASSIFY_AND_EXTRACT_SYSTEM_MSG,
+                {"role": "user", "content": prompt}
+            ],
+            'temperature': 0.3,
+            'max_tokens': 1000,
+            'response_format': {"type": "json_object"}
+        }
+    
+    def _pack_threads(self, emails_texts: List[str], max_tokens: int, static_text: str) -> str:
+        """Join threads under numbered markers, truncated so the request fits the model's context window
+        
+        static_text is the rest of the request (system message and prompt around the threads).
+        """
+        overhead = len(static_text) // 4
+        thread_tokens = min(
+            Config.MAX_INPUT_TOKENS,
+            # Less a few tokens per thread for its marker and truncation note
+            (Config.MODEL_CONTEXT_TOKENS - max_tokens - overhead) // len(emails_texts) - 16
+        )
+        
+        return "\n\n".join([
+            f"=== THREAD {i} ===\n{self._truncate(emails_text, thread_tokens)}"
+            for i, emails_text in enumerate(emails_texts)
         ])
+    
+    async def submit_batch(self, threads_text: Dict[str, str]) -> str:
+        """Upload classify-and-extract requests to the Batch API, returning the batch id
         
-        prompt = f"""Extract all technical requirements from this email thread.
-
-For each requirement, provide:
-1. Requirement text (clear and concise)
-2. Category (e.g., functionality, performance, integration, security, deployment)
-3. Priority (high, medium, low)
-
-Email Thread:
-{emails_text}
-
-Format your response as a numbered list with categories."""
-
-        try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": "You are a requirements extraction expert."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.5,
-                max_tokens=1000
-            )
+        threads_text maps each thread id to its format_thread text.
+        """
+        url = '/chat/completions' if self.use_azure else '/v1/chat/completions'
+        
+        lines = [
+            json.dumps({
+                'custom_id': thread_id,
+                'method': 'POST',
+                'url': url,
+                'body': self._classify_and_extract_request(emails_text)
+            })
+            for thread_id, emails_text in threads_text.items()
+        ]
+        
+        batch_file = await self.client.files.create(
+            file=('requirement_threads.jsonl', "\n".join(lines).encode('utf-8')),
+            purpose='batch'
+        )
+        batch = await self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint=url,
+            completion_window='24h'
+        )
+        
+        return batch.id
+    
+    async def wait_for_batch(self, batch_id: str, poll_interval: float = None):
+        """Poll the Batch API until the batch reaches a terminal status"""
+        if poll_interval is None:
+            poll_interval = Config.BATCH_POLL_INTERVAL
+        
+        while True:
+            batch = await self.client.batches.retrieve(batch_id)
+            
+            if batch.status == 'completed':
+                return batch
+            if batch.status in ['failed', 'expired', 'cancelled']:
+                raise RuntimeError(f"Batch {batch_id} ended with status '{batch.status}'")
+            
+            print(f"⏳ Batch {batch_id} is {batch.status}, checking again in {poll_interval}s")
+            await asyncio.sleep(poll_interval)
+    
+    async def fetch_batch_results(self, batch) -> Dict[str, Dict]:
+        """Download a completed batch and return {category, requirements} keyed by thread id"""
+        if not batch.output_file_id:
+            return {}
+        
+        content = await self.client.files.content(batch.output_file_id)
+        
+        results = {}
+        for line in content.text.splitlines():
+            if not line.strip():
+                continue
+            
+            record = json.loads(line)
+            response = record.get('response') or {}
             
-            extracted_text = response.choices[0].message.content.strip()
+            if response.get('status_code') != 200:
+                print(f"❌ Batch request failed for {record.get('custom_id')}: {record.get('error')}")
+                continue
             
-            return [{
-                'extracted_requirements': extracted_text,
+            try:
+                result = json.loads(response['body']['choices'][0]['message']['content'])
+                results[record['custom_id']] = self._normalize_result(result)
+            except (KeyError, IndexError, ValueError) as e:
+                print(f"❌ Batch response unusable for {record.get('custom_id')}: {e}")
+        
+        return results
+    
+    async def _create_completion(self, **request):
+        """Create a chat completion once the rate limiter has capacity for it"""
+        prompt_chars = sum(len(message['content']) for message in request['messages'])
+        estimated_tokens = prompt_chars // 4 + request.get('max_tokens', 0)
+        
+        async with self.rl.reserve(estimated_tokens=estimated_tokens):
+            return await self.client.chat.completions.create(**request)
+    
+    def _truncate(self, text: str, max_tokens: int) -> str:
+        """Cut text to max_tokens, keeping its start and end (requirements tend to sit at either)"""
+        if self._truncation_encoding is None:
+            return text
+        
+        ids = self._truncation_encoding.encode(text)
+        if len(ids) <= max_tokens:
+            return text
+        
+        half = max_tokens // 2
+        return (
+            self._truncation_encoding.decode(ids[:half])
+            + "\n...[truncated]...\n"
+            + self._truncation_encoding.decode(ids[len(ids) - half:])
+        )
+    
+    def _cache_key(self, emails_text: str) -> str:
+        """Content hash identifying a thread's emails"""
+        return hashlib.sha256(emails_text.encode('utf-8')).hexdigest()
+    
+    async def _get_cached_categories(self, keys: List[str]) -> Dict[str, str]:
+        """Look up cached classifications, checking the in-process cache before MongoDB"""
+        found = {}
+        
+        for key in keys:
+            if key in self._l1:
+                self._l1.move_to_end(key)
+                found[key] = self._l1[key]
+        
+        missing = [key for key in keys if key not in found]
+        if missing and self.cache_collection is not None:
+            # pymongo blocks, so the lookup runs on a worker thread
+            loop = asyncio.get_running_loop()
+            for key, category in (await loop.run_in_executor(None, self._find_cached, missing)).items():
+                found[key] = category
+                self._remember(key, category)
+        
+        return found
+    
+    def _find_cached(self, keys: List[str]) -> Dict[str, str]:
+        """Fetch cached classifications from MongoDB (runs on a worker thread)"""
+        return {
+            doc['_id']: doc['category']
+            for doc in self.cache_collection.find({'_id': {'$in': keys}}, {'category': 1})
+        }
+    
+    async def _cache_categories(self, categories: Dict[str, str]):
+        """Record classifications in both cache levels, with one MongoDB round-trip"""
+        for key, category in categories.items():
+            self._remember(key, category)
+        
+        if categories and self.cache_collection is not None:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self._write_cached, categories)
+    
+    def _write_cached(self, categories: Dict[str, str]):
+        """Bulk upsert classifications into MongoDB (runs on a worker thread)"""
+        now = datetime.now()
+        ops = [
+            UpdateOne({'_id': key}, {'$set': {'category': category, 'ts': now}}, upsert=True)
+            for key, category in categories.items()
+        ]
+        self.cache_collection.bulk_write(ops, ordered=False)
+    
+    def _remember(self, key: str, category: str):
+        """Store a classification in the bounded in-process cache"""
+        self._l1[key] = category
+        self._l1.move_to_end(key)
+        if len(self._l1) > CLASSIFICATION_CACHE_SIZE:
+            self._l1.popitem(last=False)
+    
+    def _normalize_result(self, result: Dict) -> Dict:
+        """Coerce a parsed AI response into {category, requirements}"""
+        category = str(result.get('category', '')).strip().lower()
+        if category not in ['requirement', 'general']:
+            category = 'general'
+        
+        requirements = self._normalize_requirements(result.get('requirements')) if category == 'requirement' else []
+        
+        return {'category': category, 'requirements': requirements}
+    
+    def _normalize_requirements(self, requirements) -> List[Dict]:
+        """Coerce a parsed AI requirements list into requirement dicts tagged with their source"""
+        return [
+            {
+                **(req if isinstance(req, dict) else {'text': str(req)}),
                 'extraction_method': 'AI',
                 'model_used': self.model
-            }]
-        
-        except Exception as e:
-            print(f"❌ AI extraction failed: {e}")
-            return []
+            }
+            for req in (requirements or [])
+        ]
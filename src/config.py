@@ -1,35 +1,87 @@
 import os
 from dotenv import load_dotenv
 
-# Load environment variables from .env file
-load_dotenv()
+def _flag(value):
+    """Parse a 'true'/'false' environment value"""
+    return value.lower() == 'true'
 
-class Config:
-    """Application configuration"""
-    
+# Setting name -> (default, cast); values are read from the environment on first access
+_SETTINGS = {
     # MongoDB Configuration
-    MONGODB_URI = os.getenv('MONGODB_URI', 'mongodb://localhost:27017/')
-    MONGODB_DB = os.getenv('MONGODB_DB', 'email_orchestrator')
+    'MONGODB_URI': ('mongodb://localhost:27017/', None),
+    'MONGODB_DB': ('email_orchestrator', None),
+    'MONGODB_BULK_WRITE_SIZE': (500, int),
+    'WORKERS': (20, int),
     
     # OpenAI Configuration
-    OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
-    OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'gpt-4')
+    'OPENAI_API_KEY': (None, None),
+    'OPENAI_MODEL': ('gpt-4o', None),
+    'CLASSIFY_MODEL': ('gpt-4o-mini', None),
+    'OPENAI_RPM': (500, int),
+    'OPENAI_TPM': (150000, int),
     
     # Azure OpenAI Configuration
-    AZURE_OPENAI_API_KEY = os.getenv('AZURE_OPENAI_API_KEY')
-    AZURE_OPENAI_ENDPOINT = os.getenv('AZURE_OPENAI_ENDPOINT')
-    AZURE_OPENAI_DEPLOYMENT = os.getenv('AZURE_OPENAI_DEPLOYMENT')
-    AZURE_OPENAI_API_VERSION = os.getenv('AZURE_OPENAI_API_VERSION', '2024-02-15-preview')
+    'AZURE_OPENAI_API_KEY': (None, None),
+    'AZURE_OPENAI_ENDPOINT': (None, None),
+    'AZURE_OPENAI_DEPLOYMENT': (None, None),
+    'AZURE_OPENAI_CLASSIFY_DEPLOYMENT': (lambda config: config.AZURE_OPENAI_DEPLOYMENT, None),
+    'AZURE_OPENAI_API_VERSION': ('2024-02-15-preview', None),
+    
+    # AI Processing Settings
+    'AI_MAX_CONCURRENCY': (20, int),
+    'AI_BATCH_SIZE': (6, int),
+    'BATCH_POLL_INTERVAL': (60, int),
+    'MAX_INPUT_TOKENS': (3000, int),
+    'MODEL_CONTEXT_TOKENS': (128000, int),
     
     # Email Configuration
-    SMTP_HOST = os.getenv('SMTP_HOST', 'smtp.gmail.com')
-    SMTP_PORT = int(os.getenv('SMTP_PORT', 587))
-    SMTP_USER = os.getenv('SMTP_USER')
-    SMTP_PASSWORD = os.getenv('SMTP_PASSWORD')
+    'SMTP_HOST': ('smtp.gmail.com', None),
+    'SMTP_PORT': (587, int),
+    'SMTP_USER': (None, None),
+    'SMTP_PASSWORD': (None, None),
     
     # Application Settings
-    ENVIRONMENT = os.getenv('ENVIRONMENT', 'development')
-    DEBUG = os.getenv('DEBUG', 'true').lower() == 'true'
+    'ENVIRONMENT': ('development', None),
+    'DEBUG': ('true', _flag),
+}
+
+class _LazyConfig(type):
+    """Resolve settings from the environment on first access and cache them"""
+    
+    _cache = {}
+    _env_loaded = False
+    
+    def __getattr__(cls, name):
+        """Look up a setting, reading it from the environment on first access"""
+        if name not in _SETTINGS:
+            raise AttributeError(f"type object 'Config' has no attribute '{name}'")
+        
+        if name not in cls._cache:
+            if not cls._env_loaded:
+                # Load environment variables from .env file
+                load_dotenv()
+                _LazyConfig._env_loaded = True
+            
+            default, cast = _SETTINGS[name]
+            value = os.getenv(name)
+            if value is None:
+                value = default(cls) if callable(default) else default
+            if cast is not None and value is not None:
+                value = cast(value)
+            cls._cache[name] = value
+        
+        return cls._cache[name]
+    
+    def __dir__(cls):
+        """List settings alongside the class attributes"""
+        return sorted(set(super().__dir__()) | set(_SETTINGS))
+    
+    def cache_clear(cls):
+        """Drop cached settings so the next access re-reads the environment"""
+        cls._cache.clear()
+
+class Config(metaclass=_LazyConfig):
+    """Application configuration"""
     
     @classmethod
     def validate(cls):
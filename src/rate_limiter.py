@@ -0,0 +1,58 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+class RateLimiter:
+    """Token-bucket limiter that paces API calls under requests/min and tokens/min limits"""
+    
+    def __init__(self, rpm_capacity: int, tpm_capacity: int):
+        """Start with full buckets; both refill continuously at their per-minute rate"""
+        self.rpm_capacity = rpm_capacity
+        self.tpm_capacity = tpm_capacity
+        self.available_requests = float(rpm_capacity)
+        self.available_tokens = float(tpm_capacity)
+        self._last_refill = time.monotonic()
+        self._lock = None
+        self._lock_loop = None
+    
+    @asynccontextmanager
+    async def reserve(self, estimated_tokens: int):
+        """Wait until one request and estimated_tokens fit in the buckets, then consume them"""
+        # A single oversized request would otherwise wait forever
+        estimated_tokens = min(estimated_tokens, self.tpm_capacity)
+        
+        # Waiters queue on the lock, so capacity is handed out in arrival order
+        async with self._get_lock():
+            while True:
+                self._refill()
+                
+                if self.available_requests >= 1 and self.available_tokens >= estimated_tokens:
+                    self.available_requests -= 1
+                    self.available_tokens -= estimated_tokens
+                    break
+                
+                await asyncio.sleep(max(
+                    (1 - self.available_requests) * 60 / self.rpm_capacity,
+                    (estimated_tokens - self.available_tokens) * 60 / self.tpm_capacity,
+                    0.01
+                ))
+        
+        yield
+    
+    def _refill(self):
+        """Add the capacity accrued since the last refill"""
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        
+        self.available_requests = min(self.rpm_capacity, self.available_requests + self.rpm_capacity * elapsed / 60)
+        self.available_tokens = min(self.tpm_capacity, self.available_tokens + self.tpm_capacity * elapsed / 60)
+    
+    def _get_lock(self) -> asyncio.Lock:
+        """Lock bound to the running event loop (each asyncio.run gets a new loop)"""
+        loop = asyncio.get_running_loop()
+        if self._lock is None or self._lock_loop is not loop:
+            self._lock = asyncio.Lock()
+            self._lock_loop = loop
+        
+        return self._lock
@@ -1,23 +1,113 @@
+import asyncio
+import functools
 import re
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime
-from pymongo import MongoClient
-from typing import List, Dict
+from itertools import islice
+from pymongo import MongoClient, UpdateOne
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 from src.config import Config
-from src.ai_processor import AIEmailProcessor
+from src.ai_processor import AIEmailProcessor, format_thread
+
+try:
+    import ahocorasick
+except ImportError:  # optional: keyword matching falls back to a compiled regex
+    ahocorasick = None
+
+REQUIREMENT_KEYWORDS = [
+    'requirement', 'need', 'feature', 'functionality',
+    'system', 'integration', 'users', 'deployment',
+    'timeline', 'alert', 'notification', 'access',
+    'permission', 'tracking', 'audit', 'compliance',
+    'dashboard', 'report', 'api', 'database',
+    'authentication', 'security', 'performance',
+    'scalability', 'interface', 'workflow'
+]
+
+# Email header lines, e.g. "Subject: Re: Requirement for Inventory Management System"
+EMAIL_HEADER_RE = re.compile(r'(From|To|Date|Subject):(.*)')
+
+# Phrases typical of threads with nothing to extract (thanks, holidays, out of office)
+TRIVIAL_PATTERNS = [r'thanks?', r'thank you', r'happy holidays', r'ooo', r'out of office']
+
+@functools.lru_cache(maxsize=1)
+def _get_client() -> MongoClient:
+    """Shared MongoDB client, created on first use and reused across agents"""
+    # Ingest-only workload: acknowledged but unjournaled writes are enough
+    return MongoClient(
+        Config.MONGODB_URI,
+        maxPoolSize=50,
+        w=1,
+        journal=False,
+        retryWrites=True
+    )
+
+@dataclass(slots=True)
+class RequirementDoc:
+    """A requirement thread ready to be upserted into MongoDB"""
+    thread_id: str
+    emails: list
+    email_count: int
+    requirements: list
+    client: Optional[str]
+    subject: Optional[str]
+    first_date: Optional[str]
+    last_date: Optional[str]
+    created_at: datetime
+    classification_method: str
+    
+    def to_document(self) -> Dict:
+        """Stored document shape, with sender/subject/dates nested under 'metadata'"""
+        return {
+            'thread_id': self.thread_id,
+            'category': 'requirement',
+            'emails': self.emails,
+            'email_count': self.email_count,
+            'requirements': self.requirements,
+            'metadata': {
+                'client': self.client,
+                'subject': self.subject,
+                'first_date': self.first_date,
+                'last_date': self.last_date,
+            },
+            'created_at': self.created_at,
+            'classification_method': self.classification_method
+        }
+
+def _chunked(items: Iterable, size: int) -> Iterator[List]:
+    """Yield successive lists of at most `size` items"""
+    iterator = iter(items)
+    while batch := list(islice(iterator, size)):
+        yield batch
 
 class RequirementAgent:
     """Agent to process and store requirement-related email conversations"""
     
     def __init__(self, use_ai=True):
         """Initialize MongoDB connection and AI processor"""
-        self.client = MongoClient(Config.MONGODB_URI)
+        self.client = _get_client()
         self.db = self.client[Config.MONGODB_DB]
         self.requirements_collection = self.db['requirement_emails']
+        self.requirements_collection.create_index([('thread_id', 1)], unique=True)
         self.use_ai = use_ai
+        self._loop = None
+        
+        # Keywords match anywhere in the text, as with the original substring check
+        self._req_re = re.compile('|'.join(map(re.escape, REQUIREMENT_KEYWORDS)), re.I)
+        self._triv_re = re.compile(r'\b(' + '|'.join(TRIVIAL_PATTERNS) + r')\b', re.I)
+        
+        # Aho-Corasick finds any keyword in one pass over the text, in C
+        self._ac = None
+        if ahocorasick is not None:
+            self._ac = ahocorasick.Automaton()
+            for keyword in REQUIREMENT_KEYWORDS:
+                self._ac.add_word(keyword, keyword)
+            self._ac.make_automaton()
         
         if use_ai:
             try:
-                self.ai_processor = AIEmailProcessor()
+                self.ai_processor = AIEmailProcessor(db=self.db)
                 print("✅ AI Processor initialized")
             except Exception as e:
                 print(f"⚠️  AI initialization failed: {e}")
@@ -26,103 +116,87 @@ class RequirementAgent:
     
     def parse_email_file(self, file_path: str) -> List[Dict]:
         """Parse the email conversations file into threads"""
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
+        return list(self.iter_threads(file_path))
+    
+    def iter_threads(self, file_path: str) -> Iterator[Dict]:
+        """Stream threads from the email conversations file, one at a time
         
-        threads = []
-        thread_blocks = content.split('THREAD_ID: ')[1:]
+        Each line is applied directly to the email being built, so no thread or
+        email text is ever buffered and re-split.
+        """
+        thread = None
+        email_data = None  # None until the thread's first '---' separator
+        body_lines = []
+        has_content = False
         
-        for block in thread_blocks:
-            lines = block.strip().split('\n')
-            thread_id = lines[0].strip()
-            
-            emails = []
-            email_parts = block.split('---\n')[1:]
-            
-            for part in email_parts:
-                if not part.strip():
-                    continue
+        with open(file_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.rstrip('\n')
                 
-                email_data = self._parse_single_email(part)
-                if email_data:
-                    emails.append(email_data)
-            
-            if emails:
-                threads.append({
-                    'thread_id': thread_id,
-                    'emails': emails
-                })
+                if line.startswith('THREAD_ID: '):
+                    if thread is not None:
+                        self._close_email(thread, email_data, body_lines, has_content)
+                        if thread['emails']:
+                            yield thread
+                    
+                    thread = {'thread_id': line[len('THREAD_ID: '):].strip(), 'emails': []}
+                    email_data = None
+                elif thread is None:
+                    continue
+                elif line.strip() == '---':
+                    # Separator closes the current email and opens the next one
+                    self._close_email(thread, email_data, body_lines, has_content)
+                    email_data, body_lines, has_content = {}, [], False
+                elif email_data is not None and line.strip():
+                    self._parse_email_line(email_data, body_lines, line)
+                    has_content = True
         
-        return threads
+        if thread is not None:
+            self._close_email(thread, email_data, body_lines, has_content)
+            if thread['emails']:
+                yield thread
     
-    def _parse_single_email(self, email_text: str) -> Dict:
-        """Parse a single email from text"""
-        lines = [line for line in email_text.split('\n') if line.strip()]
-        
-        email_data = {}
-        body_lines = []
-        parsing_body = False
-        
-        for line in lines:
-            if line.startswith('From:'):
-                email_data['from'] = line.replace('From:', '').strip()
-            elif line.startswith('To:'):
-                email_data['to'] = line.replace('To:', '').strip()
-            elif line.startswith('Date:'):
-                email_data['date'] = line.replace('Date:', '').strip()
-            elif line.startswith('Subject:'):
-                email_data['subject'] = line.replace('Subject:', '').strip()
-                parsing_body = True
-            elif parsing_body and line.strip() != '---':
-                body_lines.append(line.strip())
+    def _close_email(self, thread: Dict, email_data: Optional[Dict], body_lines: List[str], has_content: bool):
+        """Finish the email being built and add it to its thread (blank emails are dropped)"""
+        if email_data is None or not has_content:
+            return
         
         email_data['body'] = '\n'.join(body_lines)
-        return email_data
+        thread['emails'].append(email_data)
+    
+    def _parse_email_line(self, email_data: Dict, body_lines: List[str], line: str):
+        """Apply one non-blank line to an email's headers or body"""
+        header = EMAIL_HEADER_RE.match(line)
+        
+        if header:
+            email_data[header.group(1).lower()] = header.group(2).strip()
+        elif 'subject' in email_data and line.strip() != '---':
+            # Body starts after the Subject header
+            body_lines.append(line.strip())
+    
+    def _thread_text(self, thread: Dict) -> str:
+        """Subjects and bodies of all emails in a thread, joined for matching"""
+        return ' '.join(
+            email.get('subject', '') + ' ' + email.get('body', '')
+            for email in thread['emails']
+        )
     
     def is_requirement_thread_keyword(self, thread: Dict) -> bool:
         """Detect if thread contains requirements using keyword matching"""
-        requirement_keywords = [
-            'requirement', 'need', 'feature', 'functionality',
-            'system', 'integration', 'users', 'deployment',
-            'timeline', 'alert', 'notification', 'access',
-            'permission', 'tracking', 'audit', 'compliance',
-            'dashboard', 'report', 'api', 'database',
-            'authentication', 'security', 'performance',
-            'scalability', 'interface', 'workflow'
-        ]
-        
-        # Check subject and body of all emails
-        for email in thread['emails']:
-            text = (email.get('subject', '') + ' ' + email.get('body', '')).lower()
-            
-            if any(keyword in text for keyword in requirement_keywords):
-                return True
-        
-        return False
+        # Check subject and body of all emails in a single scan
+        return self._has_requirement_keyword(self._thread_text(thread))
     
-    def classify_thread(self, thread: Dict) -> str:
-        """Classify thread as requirement or general"""
-        if self.use_ai:
-            try:
-                category = self.ai_processor.classify_email_thread(thread)
-                return category
-            except Exception as e:
-                print(f"⚠️  AI classification failed for {thread['thread_id']}: {e}")
-                print("   Using keyword-based classification")
-                return 'requirement' if self.is_requirement_thread_keyword(thread) else 'general'
-        else:
-            return 'requirement' if self.is_requirement_thread_keyword(thread) else 'general'
+    def is_trivial_thread(self, thread: Dict) -> bool:
+        """Detect threads that are obviously general (only thanks, holidays, etc.)"""
+        text = self._thread_text(thread)
+        return not self._has_requirement_keyword(text) and self._triv_re.search(text) is not None
     
-    def extract_requirements(self, thread: Dict) -> List[Dict]:
-        """Extract requirements from thread"""
-        if self.use_ai:
-            try:
-                return self.ai_processor.extract_requirements(thread)
-            except Exception as e:
-                print(f"⚠️  AI extraction failed: {e}")
-                return self._extract_requirements_basic(thread)
-        else:
-            return self._extract_requirements_basic(thread)
+    def _has_requirement_keyword(self, text: str) -> bool:
+        """Check text for any requirement keyword"""
+        if self._ac is not None:
+            return next(self._ac.iter(text.lower()), None) is not None
+        
+        return self._req_re.search(text) is not None
     
     def _extract_requirements_basic(self, thread: Dict) -> List[str]:
         """Basic requirement extraction without AI"""
@@ -141,79 +215,256 @@ class RequirementAgent:
         
         return requirements
     
-    def store_requirement_thread(self, thread: Dict):
-        """Store requirement thread in MongoDB"""
-        category = self.classify_thread(thread)
+    async def analyze_threads(self, threads: List[Dict]) -> List[Dict]:
+        """Classify threads and extract requirements
+        
+        Returns one {category, requirements, classification_method} per thread.
+        """
+        if self.use_ai:
+            try:
+                # Obviously general threads skip the AI entirely
+                results = [{'category': 'general', 'requirements': [], 'classification_method': 'keyword'} for _ in threads]
+                pending = [i for i, thread in enumerate(threads) if not self.is_trivial_thread(thread)]
+                
+                if pending:
+                    texts = [format_thread(threads[i]) for i in pending]
+                    
+                    # One cheap classify-model request screens the batch; only requirement threads reach extraction
+                    categories = await self.ai_processor.classify_email_threads(texts)
+                    requirement = [(i, text) for i, text, category in zip(pending, texts, categories) if category == 'requirement']
+                    
+                    if requirement:
+                        # Screened threads share a single extraction round-trip
+                        extracted = await self.ai_processor.extract_requirements_batch(
+                            [text for _, text in requirement]
+                        )
+                        for (i, _), requirements in zip(requirement, extracted):
+                            if requirements is None:
+                                # Extraction was unusable: keep the thread, with keyword requirements
+                                requirements = self._extract_requirements_basic(threads[i])
+                            results[i] = {'category': 'requirement', 'requirements': requirements, 'classification_method': 'AI'}
+                
+                return results
+            except Exception as e:
+                print(f"⚠️  AI batch processing failed: {e}")
+                print("   Using keyword-based classification")
+        
+        results = []
+        for thread in threads:
+            if self.is_requirement_thread_keyword(thread):
+                results.append({'category': 'requirement', 'requirements': self._extract_requirements_basic(thread), 'classification_method': 'keyword'})
+            else:
+                results.append({'category': 'general', 'requirements': [], 'classification_method': 'keyword'})
+        
+        return results
+    
+    def store_requirement_thread(self, thread: Dict, result: Dict, created_at: datetime = None) -> Optional[RequirementDoc]:
+        """Build the document for a requirement thread (None if the thread is skipped)"""
+        category = result['category']
         
         if category != 'requirement':
             print(f"⏭️  Skipping {thread['thread_id']} - classified as {category}")
-            return False
+            return None
         
-        # Extract requirements
-        requirements = self.extract_requirements(thread)
+        requirements = result['requirements']
+        emails = thread['emails']
+        first = emails[0] if emails else {}
+        last = emails[-1] if emails else {}
         
-        # Prepare document
-        document = {
-            'thread_id': thread['thread_id'],
-            'category': 'requirement',
-            'emails': thread['emails'],
-            'email_count': len(thread['emails']),
-            'requirements': requirements,
-            'metadata': {
-                'client': thread['emails'][0].get('from') if thread['emails'] else None,
-                'subject': thread['emails'][0].get('subject') if thread['emails'] else None,
-                'first_date': thread['emails'][0].get('date') if thread['emails'] else None,
-                'last_date': thread['emails'][-1].get('date') if thread['emails'] else None,
-            },
-            'created_at': datetime.now(),
-            'classification_method': 'AI' if self.use_ai else 'keyword'
-        }
-        
-        # Store in MongoDB
-        result = self.requirements_collection.update_one(
-            {'thread_id': thread['thread_id']},
-            {'$set': document},
-            upsert=True
+        doc = RequirementDoc(
+            thread_id=thread['thread_id'],
+            emails=emails,
+            email_count=len(emails),
+            requirements=requirements,
+            client=first.get('from'),
+            subject=first.get('subject'),
+            first_date=first.get('date'),
+            last_date=last.get('date'),
+            created_at=created_at or datetime.now(),
+            classification_method=result['classification_method']
         )
         
-        if result.upserted_id:
-            print(f"✅ STORED: {thread['thread_id']} - {len(requirements)} requirements extracted")
-        else:
-            print(f"🔄 UPDATED: {thread['thread_id']}")
+        print(f"✅ REQUIREMENT: {thread['thread_id']} - {len(requirements)} requirements extracted")
         
-        return True
+        # Written to MongoDB in bulk by _write_in_background
+        return doc
+    
+    def _write_documents(self, docs: List[RequirementDoc]):
+        """Bulk upsert documents, returning the BulkWriteResult (safe to call from worker threads)"""
+        ops = [
+            UpdateOne({'thread_id': doc.thread_id}, {'$set': doc.to_document()}, upsert=True)
+            for doc in docs
+        ]
+        return self.requirements_collection.bulk_write(ops, ordered=False, bypass_document_validation=True)
     
-    def process_all_requirements(self, file_path: str):
-        """Process all conversations and store only requirements"""
+    def process_all_requirements(self, file_path: str, use_batch_api: bool = False):
+        """Process all conversations and store only requirements
+        
+        With use_batch_api, AI requests go through the OpenAI Batch API
+        (cheaper, higher rate limits, but results can take up to 24h).
+        """
         print("="*60)
         print("🤖 REQUIREMENT AGENT STARTED")
         print("="*60)
         print(f"📁 Reading conversations from: {file_path}")
         
-        threads = self.parse_email_file(file_path)
-        print(f"📊 Found {len(threads)} total threads\n")
-        
-        requirement_count = 0
-        
-        for i, thread in enumerate(threads, 1):
-            print(f"\n[{i}/{len(threads)}] Processing {thread['thread_id']}...")
+        if use_batch_api and self.use_ai:
+            # Every request goes into one upload, so the batch path needs all threads up front
+            threads = self.parse_email_file(file_path)
+            print(f"📊 Found {len(threads)} total threads\n")
             
-            if self.store_requirement_thread(thread):
-                requirement_count += 1
+            thread_count = len(threads)
+            requirement_count = self._run(self._process_threads_batch_api(threads))
+        else:
+            thread_count, requirement_count = self._run(self._process_threads(self.iter_threads(file_path)))
         
         print("\n" + "="*60)
         print("✅ PROCESSING COMPLETE")
         print("="*60)
-        print(f"📊 Total threads processed: {len(threads)}")
+        print(f"📊 Total threads processed: {thread_count}")
         print(f"✅ Requirement threads stored: {requirement_count}")
-        print(f"⏭️  Non-requirement threads skipped: {len(threads) - requirement_count}")
+        print(f"⏭️  Non-requirement threads skipped: {thread_count - requirement_count}")
         print(f"💾 MongoDB Collection: {self.requirements_collection.name}")
         print("="*60)
     
+    def _run(self, coro):
+        """Run a coroutine on the agent's event loop
+        
+        The loop stays open between calls so pooled AI connections remain usable
+        until close().
+        """
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+        
+        return self._loop.run_until_complete(coro)
+    
+    async def _process_threads(self, threads: Iterable[Dict]) -> Tuple[int, int]:
+        """Process threads in batches, keeping up to AI_MAX_CONCURRENCY batches in flight
+        
+        Threads are pulled from the iterable only as slots free up, so memory
+        stays bounded by the in-flight batches. MongoDB writes run on worker
+        threads so they overlap with pending AI requests instead of blocking
+        the event loop. Returns (processed, stored) counts.
+        """
+        semaphore = asyncio.Semaphore(Config.AI_MAX_CONCURRENCY)
+        docs = []
+        tasks = []
+        writes = []
+        thread_count = 0
+        
+        with ThreadPoolExecutor(max_workers=Config.WORKERS) as executor:
+            for batch in _chunked(threads, Config.AI_BATCH_SIZE):
+                # Released by _process_batch once the batch's AI work is done
+                await semaphore.acquire()
+                tasks.append(asyncio.create_task(self._process_batch(semaphore, docs, thread_count + 1, batch)))
+                thread_count += len(batch)
+                
+                if len(docs) >= Config.MONGODB_BULK_WRITE_SIZE:
+                    self._schedule_flush(executor, docs, writes)
+            
+            stored_counts = await asyncio.gather(*tasks)
+            self._schedule_flush(executor, docs, writes)
+            await asyncio.gather(*writes)
+        
+        return thread_count, sum(stored_counts)
+    
+    def _schedule_flush(self, executor: ThreadPoolExecutor, docs: List[RequirementDoc], writes: List[asyncio.Task]):
+        """Hand the buffered documents to a worker thread for writing"""
+        if not docs:
+            return
+        
+        writes.append(asyncio.create_task(self._write_in_background(executor, docs[:])))
+        docs.clear()
+    
+    async def _write_in_background(self, executor: ThreadPoolExecutor, docs: List[RequirementDoc]):
+        """Write documents on a worker thread, reporting back on the event loop thread"""
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(executor, self._write_documents, docs)
+        
+        # Printed here rather than in the worker so output never interleaves mid-line
+        print(f"💾 Wrote {len(docs)} requirement threads ({result.upserted_count} stored, {result.matched_count} updated)")
+    
+    async def _process_batch(self, semaphore: asyncio.Semaphore, docs: List[RequirementDoc], start: int, batch: List[Dict]) -> int:
+        """Process a batch of threads holding a concurrency slot, buffering their documents in docs"""
+        try:
+            for i, thread in enumerate(batch, start):
+                print(f"\n[{i}] Processing {thread['thread_id']}...")
+            
+            results = await self.analyze_threads(batch)
+        finally:
+            semaphore.release()
+        
+        stored = 0
+        now = datetime.now()
+        for thread, result in zip(batch, results):
+            doc = self.store_requirement_thread(thread, result, created_at=now)
+            if doc:
+                docs.append(doc)
+                stored += 1
+        
+        return stored
+    
+    async def _process_threads_batch_api(self, threads: List[Dict]) -> int:
+        """Process threads through the OpenAI Batch API"""
+        batch_id = await self.ai_processor.submit_batch(
+            {thread['thread_id']: format_thread(thread) for thread in threads}
+        )
+        print(f"📤 Submitted batch {batch_id} with {len(threads)} threads")
+        
+        batch = await self.ai_processor.wait_for_batch(batch_id)
+        results = await self.ai_processor.fetch_batch_results(batch)
+        print(f"📥 Batch {batch_id} completed with {len(results)} results\n")
+        
+        requirement_count = 0
+        missing = []
+        docs = []
+        writes = []
+        
+        now = datetime.now()
+        
+        with ThreadPoolExecutor(max_workers=Config.WORKERS) as executor:
+            for thread in threads:
+                result = results.get(thread['thread_id'])
+                if result is None:
+                    missing.append(thread)
+                    continue
+                
+                doc = self.store_requirement_thread(thread, {**result, 'classification_method': 'AI'}, created_at=now)
+                if doc:
+                    docs.append(doc)
+                    requirement_count += 1
+                
+                if len(docs) >= Config.MONGODB_BULK_WRITE_SIZE:
+                    self._schedule_flush(executor, docs, writes)
+            
+            self._schedule_flush(executor, docs, writes)
+            await asyncio.gather(*writes)
+        
+        if missing:
+            print(f"⚠️  {len(missing)} threads missing from batch output, processing them directly")
+            requirement_count += (await self._process_threads(missing))[1]
+        
+        return requirement_count
+    
     def get_all_requirements(self):
         """Retrieve all stored requirement threads"""
         return list(self.requirements_collection.find())
     
+    def iter_requirement_summaries(self):
+        """Stream stored threads with only the fields a summary needs
+        
+        Emails and requirement text stay on the server; only their count comes back.
+        """
+        return self.requirements_collection.aggregate([
+            {'$project': {
+                'thread_id': 1,
+                'metadata': 1,
+                'email_count': 1,
+                'req_count': {'$size': {'$ifNull': ['$requirements', []]}},
+                'classification_method': 1
+            }}
+        ])
+    
     def get_requirements_summary(self):
         """Get summary of stored requirements"""
         total = self.requirements_collection.count_documents({})
@@ -224,19 +475,27 @@ class RequirementAgent:
         print(f"Total requirement threads: {total}\n")
         
         if total > 0:
-            requirements = self.get_all_requirements()
-            
-            for req in requirements:
+            for req in self.iter_requirement_summaries():
                 print(f"🔹 {req['thread_id']}")
                 print(f"   Subject: {req['metadata']['subject']}")
                 print(f"   Client: {req['metadata']['client']}")
                 print(f"   Emails: {req['email_count']}")
-                print(f"   Requirements: {len(req.get('requirements', []))}")
+                print(f"   Requirements: {req['req_count']}")
                 print(f"   Method: {req.get('classification_method', 'N/A')}")
                 print()
         
         print("="*60)
     
     def close(self):
-        """Close MongoDB connection"""
-        self.client.close()
+        """Close AI connections
+        
+        The MongoDB client is shared by every agent in the process, so it is
+        left open for any agent still using it.
+        """
+        if self.use_ai:
+            self._run(self.ai_processor.aclose())
+        
+        if self._loop is not None:
+            self._loop.run_until_complete(self._loop.shutdown_default_executor())
+            self._loop.close()
+            self._loop = None